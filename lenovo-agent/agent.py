@@ -16,19 +16,31 @@ Access from Qubes/Cursor:
 """
 
 import asyncio
-import json
+import functools
+import logging
 import os
 import platform
+import re
 import shutil
-import subprocess
+import signal
+import struct
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from typing import Optional
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+import httpx
+import orjson
+import psutil
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
+
+log = logging.getLogger("qubes-kvm-agent")
 
 app = FastAPI(
     title="Qubes KVM Agent",
@@ -49,10 +61,54 @@ BRIDGE_SCRIPT = SCRIPTS_DIR / "xen-kvm-bridge.sh"
 
 BOOT_TIME = time.time()
 
+_HOSTNAME = platform.node()
+_ARCH = platform.machine()
+_KERNEL = platform.release()
+_CPU_COUNT = psutil.cpu_count()
+_MEM_GB = round(psutil.virtual_memory().total / (1024**3), 1)
+_PY_VERSION = sys.version.split()[0]
+
+_STATIC_INFO = {
+    "hostname": _HOSTNAME,
+    "arch": _ARCH,
+    "kernel": _KERNEL,
+    "cpu_count": _CPU_COUNT,
+    "memory_gb": _MEM_GB,
+    "python": _PY_VERSION,
+    "project_dir": str(PROJECT_DIR),
+}
+
+STDOUT_TAIL = 50000
+STDERR_TAIL = 10000
+READ_CHUNK = 65536
+EXECUTOR_WORKERS = 8
+STATUS_TTL = 2.0
+BRIDGE_TTL = 0.5
+
+_GPU_RE = re.compile(r"\b(VGA|3D|Display|GPU|Accelerators?)\b", re.IGNORECASE)
+_MD_SECTION_RE = re.compile(r"^(?=#{1,6} )", re.MULTILINE)
+
+WS_STDOUT = 1
+WS_STDERR = 2
+WS_DONE = 3
+WS_FRAME_HEADER = struct.Struct("!BI")
+WS_FLUSH_INTERVAL = 0.01
+WS_BATCH_BYTES = 256 * 1024
+# Queue items are blocks of up to ~2 * READ_CHUNK bytes, not lines, so this
+# bounds queued output per connection to roughly 2 * WS_BATCH_BYTES.
+WS_QUEUE_SIZE = WS_BATCH_BYTES // READ_CHUNK
+
 
 # ── Models ───────────────────────────────────────────────────────
 
+# These are Pydantic v2's defaults; spelled out so request models don't
+# silently change behaviour if the defaults ever move.
+_REQUEST_CONFIG = ConfigDict(
+    extra="ignore", str_strip_whitespace=False, validate_default=False,
+)
+
 class CommandRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
     command: str
     cwd: Optional[str] = None
     timeout: int = 300
@@ -64,56 +120,179 @@ class CommandResult(BaseModel):
     duration_ms: int
 
 class CrawlRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
     url: str
     extract_text: bool = True
     extract_links: bool = False
 
 class FileReadRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
     path: str
     offset: int = 0
     limit: int = 0
 
 class FileWriteRequest(BaseModel):
+    model_config = _REQUEST_CONFIG
     path: str
     content: str
 
+_COMMAND_ADAPTER = TypeAdapter(CommandRequest)
+
 
 # ── Helpers ──────────────────────────────────────────────────────
 
-def run_cmd(cmd: str, cwd: str | None = None, timeout: int = 300) -> CommandResult:
-    start = time.monotonic()
+class _TailBuffer:
+    """Fixed-size ring buffer that keeps only the last ``size`` bytes written."""
+
+    def __init__(self, size: int):
+        self.buf = bytearray(size)
+        self.pos = 0
+        self.full = False
+
+    def write(self, data: bytes) -> None:
+        size = len(self.buf)
+        if len(data) >= size:
+            self.buf[:] = data[-size:]
+            self.pos = 0
+            self.full = True
+            return
+        end = self.pos + len(data)
+        if end <= size:
+            self.buf[self.pos:end] = data
+        else:
+            split = size - self.pos
+            self.buf[self.pos:] = data[:split]
+            self.buf[:end - size] = data[split:]
+        if end >= size:
+            self.full = True
+        self.pos = end % size
+
+    def getvalue(self) -> str:
+        if self.full:
+            data = self.buf[self.pos:] + self.buf[:self.pos]
+        else:
+            data = self.buf[:self.pos]
+        return bytes(data).decode("utf-8", "replace")
+
+
+async def _drain(pipe: asyncio.StreamReader, tail: _TailBuffer) -> None:
+    while chunk := await pipe.read(READ_CHUNK):
+        tail.write(chunk)
+
+
+def _kill_group(proc: asyncio.subprocess.Process) -> None:
+    """SIGKILL the whole process group so shell children release the pipes."""
     try:
-        r = subprocess.run(
-            cmd, shell=True, capture_output=True, text=True,
-            cwd=cwd or str(PROJECT_DIR), timeout=timeout,
-        )
-        duration = int((time.monotonic() - start) * 1000)
-        return CommandResult(
-            exit_code=r.returncode,
-            stdout=r.stdout[-50000:],
-            stderr=r.stderr[-10000:],
-            duration_ms=duration,
-        )
-    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def _collect(proc: asyncio.subprocess.Process, start: float, timeout: int) -> CommandResult:
+    """Drain a child's pipes into tail buffers and wait for it to exit."""
+    stdout, stderr = _TailBuffer(STDOUT_TAIL), _TailBuffer(STDERR_TAIL)
+    pumps = asyncio.gather(
+        _drain(proc.stdout, stdout),
+        _drain(proc.stderr, stderr),
+        proc.wait(),
+    )
+    try:
+        await asyncio.wait_for(pumps, timeout)
+    except asyncio.TimeoutError:
+        _kill_group(proc)
+        # The cancelled drains may have left the pipe transports paused;
+        # read them to EOF so the child is reaped and wait() can resolve.
+        await proc.communicate()
         duration = int((time.monotonic() - start) * 1000)
         return CommandResult(exit_code=124, stdout="", stderr="TIMEOUT", duration_ms=duration)
+    except asyncio.CancelledError:
+        if pumps.done() and not pumps.cancelled():
+            pumps.exception()  # mark the drains' CancelledError as retrieved
+        _kill_group(proc)
+        await proc.communicate()
+        raise
+
+    duration = int((time.monotonic() - start) * 1000)
+    return CommandResult(
+        exit_code=proc.returncode,
+        stdout=stdout.getvalue(),
+        stderr=stderr.getvalue(),
+        duration_ms=duration,
+    )
 
 
-def get_system_info() -> dict:
-    import psutil
+async def run_cmd(cmd: str, cwd: str | None = None, timeout: int = 300) -> CommandResult:
+    """Run a shell command, keeping only the tail of stdout/stderr in memory."""
+    start = time.monotonic()
+    proc = await asyncio.create_subprocess_shell(
+        cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd or str(PROJECT_DIR),
+        start_new_session=True,
+    )
+    return await _collect(proc, start, timeout)
 
-    kvm_present = os.path.exists("/dev/kvm")
 
-    gpu_devices = []
+@functools.lru_cache(maxsize=None)
+def _which(name: str) -> str:
+    return shutil.which(name) or name
+
+
+async def run_argv(argv: list[str], cwd: str | None = None, timeout: int = 300) -> CommandResult:
+    """Like run_cmd, but exec a fixed argv directly without a /bin/sh wrapper."""
+    start = time.monotonic()
     try:
-        r = subprocess.run(
-            ["lspci"], capture_output=True, text=True, timeout=5
+        proc = await asyncio.create_subprocess_exec(
+            _which(argv[0]), *argv[1:],
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd or str(PROJECT_DIR),
+            start_new_session=True,
         )
-        for line in r.stdout.splitlines():
-            if any(kw in line.upper() for kw in ["VGA", "3D", "DISPLAY", "GPU", "ACCELERATOR"]):
-                gpu_devices.append(line.strip())
-    except Exception:
-        pass
+    except FileNotFoundError as e:
+        duration = int((time.monotonic() - start) * 1000)
+        return CommandResult(exit_code=127, stdout="", stderr=str(e), duration_ms=duration)
+    return await _collect(proc, start, timeout)
+
+
+async def _probe(*argv: str, timeout: int = 5) -> str:
+    """Run a short diagnostic command and return its stdout ("" on failure)."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError:
+        return ""
+    try:
+        out, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return ""
+    return out.decode("utf-8", "replace")
+
+
+async def _probe_lspci() -> list[str]:
+    gpu_devices = []
+    for line in (await _probe("lspci")).splitlines():
+        if _GPU_RE.search(line):
+            gpu_devices.append(line.strip())
+    return gpu_devices
+
+
+async def _probe_libvirt() -> bool:
+    return (await _probe("systemctl", "is-active", "libvirtd")).strip() == "active"
+
+
+async def get_system_info() -> dict:
+    gpu_devices, libvirt_active = await asyncio.gather(
+        _probe_lspci(), _probe_libvirt(),
+    )
+
+    kvm_present = os.path.exists("/dev/kvm")
 
     nested = "unknown"
     for path in [
@@ -127,26 +306,14 @@ def get_system_info() -> dict:
             break
 
     iommu_groups = 0
-    iommu_path = Path("/sys/kernel/iommu_groups")
-    if iommu_path.exists():
-        iommu_groups = len(list(iommu_path.iterdir()))
-
-    libvirt_active = False
     try:
-        r = subprocess.run(
-            ["systemctl", "is-active", "libvirtd"],
-            capture_output=True, text=True, timeout=5,
-        )
-        libvirt_active = r.stdout.strip() == "active"
-    except Exception:
+        with os.scandir("/sys/kernel/iommu_groups") as it:
+            iommu_groups = sum(1 for _ in it)
+    except FileNotFoundError:
         pass
 
     return {
-        "hostname": platform.node(),
-        "arch": platform.machine(),
-        "kernel": platform.release(),
-        "cpu_count": psutil.cpu_count(),
-        "memory_gb": round(psutil.virtual_memory().total / (1024**3), 1),
+        **_STATIC_INFO,
         "disk_free_gb": round(psutil.disk_usage("/").free / (1024**3), 1),
         "kvm_present": kvm_present,
         "nested_virt": nested,
@@ -154,11 +321,116 @@ def get_system_info() -> dict:
         "gpu_devices": gpu_devices,
         "libvirt_active": libvirt_active,
         "uptime_seconds": int(time.time() - BOOT_TIME),
-        "python": sys.version.split()[0],
-        "project_dir": str(PROJECT_DIR),
     }
 
 
+def _read_window(p: Path, offset: int, limit: int) -> tuple[str, int]:
+    """Return lines [offset, offset+limit) of a file and its total line count."""
+    buf = bytearray()
+    taken = 0
+    with p.open("rb", buffering=READ_CHUNK) as f:
+        skipped = sum(1 for _ in islice(f, max(offset, 0)))
+        for line in islice(f, limit if limit > 0 else None):
+            buf += line
+            taken += 1
+        remaining = sum(1 for _ in f)
+    return bytes(buf).decode("utf-8", "replace"), skipped + taken + remaining
+
+
+def _write_all(p: Path, data: bytes) -> None:
+    p.parent.mkdir(parents=True, exist_ok=True)
+    with open(p, "wb", buffering=0) as f:
+        mv = memoryview(data)
+        while mv:
+            mv = mv[f.write(mv):]
+
+
+def _ws_frames(items) -> bytearray:
+    """Pack (stream, data) pairs into frames, merging consecutive runs per stream."""
+    out = bytearray()
+    kind, payload = None, bytearray()
+    for k, data in items:
+        if k != kind and payload:
+            out += WS_FRAME_HEADER.pack(kind, len(payload))
+            out += payload
+            payload.clear()
+        kind = k
+        payload += data
+    if payload:
+        out += WS_FRAME_HEADER.pack(kind, len(payload))
+        out += payload
+    return out
+
+
+def _sse(event: str, data: dict) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+_CACHE: dict[str, list] = {}
+
+
+async def cached(key: str, ttl: float, coro_factory):
+    """Memoize a coroutine result for ``ttl`` seconds after it completes.
+
+    Concurrent callers share the same in-flight task, so a polling burst
+    runs the underlying probe once. Failures are not cached.
+    """
+    entry = _CACHE.get(key)
+    if entry is None or time.monotonic() >= entry[0]:
+        fut = asyncio.ensure_future(coro_factory())
+        # [expiry, task]; never expires while pending, expiry set on completion.
+        _CACHE[key] = entry = [float("inf"), fut]
+
+        def on_done(f: asyncio.Future) -> None:
+            if _CACHE.get(key) is not entry:
+                return
+            if f.cancelled() or f.exception() is not None:
+                del _CACHE[key]
+            else:
+                entry[0] = time.monotonic() + ttl
+
+        fut.add_done_callback(on_done)
+    return await asyncio.shield(entry[1])
+
+
+# ── Lifecycle ────────────────────────────────────────────────────
+
+@app.on_event("startup")
+async def startup():
+    app.state.executor = ThreadPoolExecutor(
+        max_workers=EXECUTOR_WORKERS, thread_name_prefix="agent",
+    )
+    asyncio.get_running_loop().set_default_executor(app.state.executor)
+
+    # Fallback client for /crawl when crawl4ai is unavailable: pooled
+    # keep-alive connections and short, finite timeouts.
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(10.0, connect=3.0),
+        limits=httpx.Limits(max_keepalive_connections=32),
+        follow_redirects=True,
+    )
+
+    app.state.crawler = None
+    try:
+        from crawl4ai import AsyncWebCrawler
+
+        crawler = AsyncWebCrawler()
+        await crawler.__aenter__()
+        app.state.crawler = crawler
+    except ImportError:
+        pass
+    except Exception as e:
+        log.warning("crawl4ai unavailable, /crawl will use plain HTTP: %s", e)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if app.state.crawler is not None:
+        await app.state.crawler.__aexit__(None, None, None)
+    await app.state.http.aclose()
+    app.state.executor.shutdown(wait=False, cancel_futures=True)
+
+
 # ── Routes ───────────────────────────────────────────────────────
 
 @app.get("/health")
@@ -168,31 +440,44 @@ async def health():
 
 @app.get("/status")
 async def status():
-    return get_system_info()
+    return await cached("status", STATUS_TTL, get_system_info)
 
 
-@app.post("/exec", response_model=CommandResult)
-async def exec_command(req: CommandRequest):
+@app.post(
+    "/exec",
+    response_model=CommandResult,
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": CommandRequest.model_json_schema()}},
+    }},
+)
+async def exec_command(request: Request):
     """Execute a shell command and return output."""
-    return await asyncio.to_thread(run_cmd, req.command, req.cwd, req.timeout)
+    try:
+        req = _COMMAND_ADAPTER.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+        ) from e
+    return await run_cmd(req.command, req.cwd, req.timeout)
 
 
 @app.post("/build")
 async def build():
     """Run make build in the project directory."""
-    return await asyncio.to_thread(run_cmd, "make build", str(PROJECT_DIR))
+    return await run_argv(["make", "build"], str(PROJECT_DIR))
 
 
 @app.post("/test")
 async def test():
     """Run make test in the project directory."""
-    return await asyncio.to_thread(run_cmd, "make test", str(PROJECT_DIR), 120)
+    return await run_argv(["make", "test"], str(PROJECT_DIR), 120)
 
 
 @app.post("/rpm")
 async def rpm():
     """Build all RPMs."""
-    return await asyncio.to_thread(run_cmd, "make rpm", str(PROJECT_DIR), 300)
+    return await run_argv(["make", "rpm"], str(PROJECT_DIR), 300)
 
 
 @app.get("/vms")
@@ -200,8 +485,9 @@ async def list_vms():
     """List Xen-on-KVM domains via xen-kvm-bridge.sh."""
     if not BRIDGE_SCRIPT.exists():
         raise HTTPException(404, "xen-kvm-bridge.sh not found")
-    result = await asyncio.to_thread(
-        run_cmd, f"bash {BRIDGE_SCRIPT} list", str(PROJECT_DIR)
+    result = await cached(
+        "vms", BRIDGE_TTL,
+        lambda: run_argv(["bash", str(BRIDGE_SCRIPT), "list"], str(PROJECT_DIR)),
     )
     return {"output": result.stdout, "exit_code": result.exit_code}
 
@@ -211,8 +497,9 @@ async def list_gpu():
     """List GPU devices available for passthrough."""
     if not BRIDGE_SCRIPT.exists():
         raise HTTPException(404, "xen-kvm-bridge.sh not found")
-    result = await asyncio.to_thread(
-        run_cmd, f"bash {BRIDGE_SCRIPT} gpu-list", str(PROJECT_DIR)
+    result = await cached(
+        "gpu", BRIDGE_TTL,
+        lambda: run_argv(["bash", str(BRIDGE_SCRIPT), "gpu-list"], str(PROJECT_DIR)),
     )
     return {"output": result.stdout, "exit_code": result.exit_code}
 
@@ -220,29 +507,63 @@ async def list_gpu():
 @app.post("/crawl")
 async def crawl(req: CrawlRequest):
     """Fetch and extract content from a URL using crawl4ai."""
-    try:
-        from crawl4ai import AsyncWebCrawler
-
-        async with AsyncWebCrawler() as crawler:
-            result = await crawler.arun(url=req.url)
-            response = {"url": req.url, "success": result.success}
-            if req.extract_text and result.markdown:
-                response["text"] = result.markdown[:100000]
-            if req.extract_links and result.links:
-                response["links"] = result.links.get("internal", [])[:100]
-            return response
-    except ImportError:
-        from urllib.request import urlopen
+    crawler = app.state.crawler
+    if crawler is None:
         try:
-            with urlopen(req.url, timeout=30) as resp:
-                body = resp.read().decode("utf-8", errors="replace")[:100000]
-            return {"url": req.url, "success": True, "text": body}
+            r = await app.state.http.get(req.url)
+            r.raise_for_status()
+            return {"url": req.url, "success": True, "text": r.text[:100000]}
         except Exception as e:
             return {"url": req.url, "success": False, "error": str(e)}
+
+    try:
+        result = await crawler.arun(url=req.url)
+        response = {"url": req.url, "success": result.success}
+        if req.extract_text and result.markdown:
+            response["text"] = result.markdown[:100000]
+        if req.extract_links and result.links:
+            response["links"] = result.links.get("internal", [])[:100]
+        return response
     except Exception as e:
         return {"url": req.url, "success": False, "error": str(e)}
 
 
+@app.get("/crawl_stream")
+async def crawl_stream(url: str, extract_links: bool = False):
+    """Stream crawl results as server-sent events.
+
+    Emits "start", one "text" event per markdown section (or per received
+    chunk in the plain-HTTP fallback), optionally "links", then "done" or "error".
+    """
+    async def events():
+        yield _sse("start", {"url": url})
+        crawler = app.state.crawler
+        try:
+            if crawler is None:
+                async with app.state.http.stream("GET", url) as r:
+                    r.raise_for_status()
+                    async for text in r.aiter_text(READ_CHUNK):
+                        yield _sse("text", {"text": text})
+                yield _sse("done", {"url": url, "success": True})
+                return
+
+            result = await crawler.arun(url=url)
+            for section in _MD_SECTION_RE.split(result.markdown or ""):
+                if section:
+                    yield _sse("text", {"text": section})
+            if extract_links and result.links:
+                yield _sse("links", {"links": result.links.get("internal", [])})
+            yield _sse("done", {"url": url, "success": result.success})
+        except Exception as e:
+            yield _sse("error", {"url": url, "success": False, "error": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/file/read")
 async def read_file(req: FileReadRequest):
     """Read a file from the filesystem."""
@@ -252,24 +573,17 @@ async def read_file(req: FileReadRequest):
     if not p.is_file():
         raise HTTPException(400, f"Not a file: {req.path}")
 
-    text = p.read_text(errors="replace")
-    lines = text.splitlines(keepends=True)
-
-    if req.offset > 0:
-        lines = lines[req.offset:]
-    if req.limit > 0:
-        lines = lines[:req.limit]
-
-    return {"path": str(p), "content": "".join(lines), "total_lines": len(text.splitlines())}
+    content, total_lines = await asyncio.to_thread(_read_window, p, req.offset, req.limit)
+    return {"path": str(p), "content": content, "total_lines": total_lines}
 
 
 @app.post("/file/write")
 async def write_file(req: FileWriteRequest):
     """Write content to a file."""
     p = Path(req.path).expanduser()
-    p.parent.mkdir(parents=True, exist_ok=True)
-    p.write_text(req.content)
-    return {"path": str(p), "bytes_written": len(req.content)}
+    data = req.content.encode("utf-8")
+    await asyncio.to_thread(_write_all, p, data)
+    return {"path": str(p), "bytes_written": len(data)}
 
 
 # ── WebSocket live shell ─────────────────────────────────────────
@@ -278,14 +592,18 @@ async def write_file(req: FileWriteRequest):
 async def ws_shell(ws: WebSocket):
     """Live interactive shell via WebSocket.
 
-    Send JSON: {"command": "make build"}
-    Receive streaming stdout/stderr lines as they appear.
+    Send JSON (text or binary frame): {"command": "make build"}
+    Receive binary messages holding one or more frames, each laid out as
+    <u8 type><u32 big-endian length><payload>. Types 1/2 carry raw
+    stdout/stderr; type 3 ends the command with JSON {"done": true, "exit_code": N}.
     """
     await ws.accept()
     try:
         while True:
-            data = await ws.receive_text()
-            msg = json.loads(data)
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            msg = orjson.loads(message.get("bytes") or message.get("text") or b"")
             cmd = msg.get("command", "")
             cwd = msg.get("cwd", str(PROJECT_DIR))
 
@@ -294,22 +612,71 @@ async def ws_shell(ws: WebSocket):
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
                 cwd=cwd,
+                start_new_session=True,
             )
 
-            async def stream(pipe, stream_name):
-                async for line in pipe:
-                    await ws.send_json({
-                        "stream": stream_name,
-                        "line": line.decode("utf-8", errors="replace").rstrip("\n"),
-                    })
-
-            await asyncio.gather(
-                stream(proc.stdout, "stdout"),
-                stream(proc.stderr, "stderr"),
-            )
+            # Bounded: when the client reads slower than the command writes,
+            # producers block, the pipes fill and the child blocks on write.
+            queue: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+
+            async def produce(pipe, kind):
+                pending = bytearray()
+                while chunk := await pipe.read(READ_CHUNK):
+                    pending += chunk
+                    cut = pending.rfind(b"\n") + 1
+                    if not cut and len(pending) >= READ_CHUNK:
+                        cut = len(pending)
+                    if cut:
+                        await queue.put((kind, bytes(pending[:cut])))
+                        del pending[:cut]
+                if pending:
+                    await queue.put((kind, bytes(pending)))
+                await queue.put(None)
+
+            async def send_output():
+                open_streams = 2
+                while open_streams:
+                    item = await queue.get()
+                    if queue.empty():
+                        await asyncio.sleep(WS_FLUSH_INTERVAL)
+                    batch, size = [], 0
+                    while True:
+                        if item is None:
+                            open_streams -= 1
+                        else:
+                            batch.append(item)
+                            size += len(item[1])
+                        if size >= WS_BATCH_BYTES or queue.empty():
+                            break
+                        item = queue.get_nowait()
+                    frames = _ws_frames(batch)
+                    if frames:
+                        # Fresh buffer per batch, so the view can be handed
+                        # to the transport without copying or later reuse.
+                        await ws.send_bytes(memoryview(frames))
+
+            tasks = [
+                asyncio.ensure_future(produce(proc.stdout, WS_STDOUT)),
+                asyncio.ensure_future(produce(proc.stderr, WS_STDERR)),
+                asyncio.ensure_future(send_output()),
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # gather() is already done once a task fails, so cancel the
+                # survivors (usually producers blocked on a full queue) here.
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                _kill_group(proc)
+                # Drain what is left so the paused pipe transports see EOF
+                # and the child is reaped.
+                await proc.communicate()
+                raise
 
             exit_code = await proc.wait()
-            await ws.send_json({"done": True, "exit_code": exit_code})
+            done = orjson.dumps({"done": True, "exit_code": exit_code})
+            await ws.send_bytes(WS_FRAME_HEADER.pack(WS_DONE, len(done)) + done)
 
     except WebSocketDisconnect:
         pass
@@ -323,6 +690,8 @@ if __name__ == "__main__":
         "agent:app",
         host="0.0.0.0",
         port=8420,
+        loop="uvloop",
+        http="httptools",
         reload=False,
         log_level="info",
     )
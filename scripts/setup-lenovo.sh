@@ -329,7 +329,7 @@ Type=simple
 User=${current_user}
 Group=${current_user}
 WorkingDirectory=${PROJECT_DIR}
-ExecStart=${AGENT_DIR}/.venv/bin/python -m uvicorn agent:app --host 0.0.0.0 --port 8420 --log-level info --app-dir ${AGENT_DIR}
+ExecStart=${AGENT_DIR}/.venv/bin/python -m uvicorn agent:app --host 0.0.0.0 --port 8420 --loop uvloop --http httptools --log-level info --app-dir ${AGENT_DIR}
 Restart=on-failure
 RestartSec=5
 StandardOutput=journal